@@ -9,9 +9,27 @@ __date__ = "02-03-2021"
 __version__ = "1.0.2"
 # pylint: disable=bare-except, broad-except
 
+# Performance notes
+# -----------------
+# Budget: DAQ at 1 Hz in a time-critical thread, GUI clock at 10 Hz and charts
+# at 2 Hz in the main thread. The costs here are event-driven and I/O- or
+# dispatch-bound rather than compute-bound, roughly in this order:
+#   1. pyqtgraph curve painting
+#   2. Qt widget updates, i.e. `setText()`
+#   3. log-file writes
+#   4. the serial round trip to the Arduino, incl. sensor conversion time
+# There is no inner numeric loop over arrays. Worthwhile optimizations are
+# therefore: doing less work per tick (gating, lazy formatting, downsampling),
+# batching I/O and keeping it off the DAQ thread. SIMD, GPU compute, JIT
+# compilation and reduced-precision data types do not pay off here. JIT via
+# Numba was rejected for the only numeric kernel, i.e. the per-tick parsing of
+# five scalars, where dispatch and array conversion would cost more than they
+# save. Profile with cProfile before adding any of those.
+
 import os
 import sys
 import time
+from collections import deque
 
 import numpy as np
 import psutil
@@ -47,9 +65,11 @@ if TRY_USING_OPENGL:
         print("To install: `conda install pyopengl` or `pip install pyopengl`")
     else:
         print("OpenGL acceleration: Enabled")
+        # Renders the charts onto an OpenGL viewport. We deliberately leave
+        # `enableExperimental` off: its raw GL curve painter is an unsupported
+        # code path that always enables `GL_LINE_SMOOTH`, bypassing the
+        # `antialias` option.
         pg.setConfigOptions(useOpenGL=True)
-        pg.setConfigOptions(antialias=True)
-        pg.setConfigOptions(enableExperimental=True)
 
 # Global pyqtgraph configuration
 # pg.setConfigOptions(leftButtonPan=False)
@@ -57,22 +77,32 @@ pg.setConfigOption("foreground", "#EEE")
 
 # Constants
 # fmt: off
-DAQ_INTERVAL_MS    = 1000  # [ms]
-CHART_INTERVAL_MS  = 500   # [ms]
-CHART_HISTORY_TIME = 3600  # [s]
+DAQ_INTERVAL_MS       = 1000  # [ms]
+CHART_INTERVAL_MS     = 500   # [ms]
+CHART_HISTORY_TIME    = 3600  # [s]
+LOG_FLUSH_INTERVAL_MS = 2000  # [ms]
 # fmt: on
 
+# Number of readings held by each chart history
+CHART_CAPACITY = round(CHART_HISTORY_TIME * 1e3 / DAQ_INTERVAL_MS)
+
+# Chart styling, shared by all plots and curves
+CHART_LABEL_STYLE = {"color": "#EEE", "font-size": "10pt"}
+PEN_01 = pg.mkPen(color=[255, 255, 0], width=3)
+PEN_02 = pg.mkPen(color=[0, 255, 255], width=3)
+
 # Show debug info in terminal? Warning: Slow! Do not leave on unintentionally.
+# Guard debug-only code with `if __debug__ and DEBUG:` so that running with
+# `python -O` strips it from the bytecode altogether.
 DEBUG = False
 
 
-def get_current_date_time():
-    cur_date_time = QDateTime.currentDateTime()
-    return (
-        cur_date_time.toString("dd-MM-yyyy"),  # Date
-        cur_date_time.toString("HH:mm:ss"),  # Time
-        cur_date_time.toString("yyMMdd_HHmmss"),  # Reverse notation date-time
-    )
+def get_current_date_time(fmt="dd-MM-yyyy HH:mm:ss"):
+    """Returns the current date-time as a string formatted by `fmt`. Only
+    call when the string is actually needed, as each call costs a system time
+    query plus locale formatting.
+    """
+    return QDateTime.currentDateTime().toString(fmt)
 
 
 # ------------------------------------------------------------------------------
@@ -85,6 +115,8 @@ class State(object):
     Arduino. There should only be one instance of the State class.
     """
 
+    __slots__ = ("time", "ds_temp", "bme_temp", "bme_humi", "bme_pres")
+
     def __init__(self):
         self.time = np.nan  # [s]
         self.ds_temp = np.nan  # ['C]
@@ -95,6 +127,16 @@ class State(object):
 
 state = State()
 
+# Data rows waiting to be written to the log file. They get appended by the DAQ
+# thread and are flushed in one go by `flush_log_buffer()`, keeping the file
+# I/O out of the time-critical DAQ loop.
+log_buffer = deque()
+
+# Guards `log` and `log_buffer` between the DAQ thread and the main thread.
+# Deliberately not `ard.mutex`: that one is held during the whole serial round
+# trip, which would stall the GUI while waiting on the flush.
+log_mutex = QtCore.QMutex()
+
 # ------------------------------------------------------------------------------
 #   MainWindow
 # ------------------------------------------------------------------------------
@@ -133,9 +175,7 @@ class MainWindow(QtWid.QWidget):
         self.qpbt_record = create_Toggle_button(
             "Click to start recording to file"
         )
-        # fmt: off
-        self.qpbt_record.clicked.connect(lambda state: log.record(state)) # pylint: disable=unnecessary-lambda
-        # fmt: on
+        self.qpbt_record.clicked.connect(record_to_log)
 
         vbox_middle = QtWid.QVBoxLayout()
         vbox_middle.addWidget(self.qlbl_title)
@@ -171,23 +211,30 @@ class MainWindow(QtWid.QWidget):
         self.gw = pg.GraphicsLayoutWidget()
 
         # Plot: Temperatures
-        p = {"color": "#EEE", "font-size": "10pt"}
         self.pi_temp = self.gw.addPlot(row=0, col=0)
-        self.pi_temp.setLabel("left", text="temperature (°C)", **p)
+        self.pi_temp.setLabel(
+            "left", text="temperature (°C)", **CHART_LABEL_STYLE
+        )
 
         # Plot: Humidity
         self.pi_humi = self.gw.addPlot(row=1, col=0)
-        self.pi_humi.setLabel("left", text="humidity (%)", **p)
+        self.pi_humi.setLabel("left", text="humidity (%)", **CHART_LABEL_STYLE)
 
         # Plot: Pressure
         self.pi_pres = self.gw.addPlot(row=2, col=0)
-        self.pi_pres.setLabel("left", text="pressure (mbar)", **p)
+        self.pi_pres.setLabel(
+            "left", text="pressure (mbar)", **CHART_LABEL_STYLE
+        )
 
         self.plots = [self.pi_temp, self.pi_humi, self.pi_pres]
         for plot in self.plots:
             plot.setClipToView(True)
+            # Only send as many points to the painter as there are pixels to
+            # draw them on. Peak-mode keeps the spikes in long histories
+            # visible. Set per plot, so that its context menu stays in sync.
+            plot.setDownsampling(auto=True, mode="peak")
             plot.showGrid(x=1, y=1)
-            plot.setLabel("bottom", text="history (s)", **p)
+            plot.setLabel("bottom", text="history (s)", **CHART_LABEL_STYLE)
             plot.setMenuEnabled(True)
             plot.enableAutoRange(axis=pg.ViewBox.XAxis, enable=False)
             plot.enableAutoRange(axis=pg.ViewBox.YAxis, enable=True)
@@ -195,24 +242,20 @@ class MainWindow(QtWid.QWidget):
             plot.setRange(xRange=[-CHART_HISTORY_TIME, 0])
 
         # Curves
-        capacity = round(CHART_HISTORY_TIME * 1e3 / DAQ_INTERVAL_MS)
-        PEN_01 = pg.mkPen(color=[255, 255, 0], width=3)
-        PEN_02 = pg.mkPen(color=[0, 255, 255], width=3)
-
         self.tscurve_ds_temp = HistoryChartCurve(
-            capacity=capacity,
+            capacity=CHART_CAPACITY,
             linked_curve=self.pi_temp.plot(pen=PEN_01, name="temp_DS"),
         )
         self.tscurve_bme_temp = HistoryChartCurve(
-            capacity=capacity,
+            capacity=CHART_CAPACITY,
             linked_curve=self.pi_temp.plot(pen=PEN_02, name="temp_BME"),
         )
         self.tscurve_bme_humi = HistoryChartCurve(
-            capacity=capacity,
+            capacity=CHART_CAPACITY,
             linked_curve=self.pi_humi.plot(pen=PEN_02, name="humi_BME"),
         )
         self.tscurve_bme_pres = HistoryChartCurve(
-            capacity=capacity,
+            capacity=CHART_CAPACITY,
             linked_curve=self.pi_pres.plot(pen=PEN_02, name="pres_BME"),
         )
 
@@ -223,6 +266,12 @@ class MainWindow(QtWid.QWidget):
             self.tscurve_bme_pres,
         ]
 
+        # Gets incremented by `DAQ_function()` each time new readings have been
+        # added to the chart histories, so that `update_chart()` can skip
+        # redrawing when nothing has changed
+        self.chart_data_counter = 0
+        self._chart_data_counter_seen = -1
+
         #  Group `Readings`
         # -------------------------
 
@@ -338,16 +387,25 @@ class MainWindow(QtWid.QWidget):
 
     @QtCore.pyqtSlot()
     def update_GUI(self):
-        str_cur_date, str_cur_time, _ = get_current_date_time()
+        """Refresh the clock and the recording time. Gets called by
+        `timer_GUI`.
+        """
         self.qlbl_cur_date_time.setText(
-            "%s    %s" % (str_cur_date, str_cur_time)
+            get_current_date_time("dd-MM-yyyy    HH:mm:ss")
         )
+        if log.is_recording():
+            self.qlbl_recording_time.setText(log.pretty_elapsed())
+
+    @QtCore.pyqtSlot()
+    def update_readings(self):
+        """Refresh the widgets showing the DAQ status and readings. These only
+        change once per DAQ update, hence this slot gets called by
+        `qdev_ard.signal_DAQ_updated` and not by `timer_GUI`.
+        """
         self.qlbl_update_counter.setText("%i" % qdev_ard.update_counter_DAQ)
         self.qlbl_DAQ_rate.setText(
             "DAQ: %.1f Hz" % qdev_ard.obtained_DAQ_rate_Hz
         )
-        if log.is_recording():
-            self.qlbl_recording_time.setText(log.pretty_elapsed())
 
         self.qlin_ds_temp.setText("%.1f" % state.ds_temp)
         self.qlin_bme_temp.setText("%.1f" % state.bme_temp)
@@ -356,7 +414,12 @@ class MainWindow(QtWid.QWidget):
 
     @QtCore.pyqtSlot()
     def update_chart(self):
-        if DEBUG:
+        chart_data_counter = self.chart_data_counter
+        if chart_data_counter == self._chart_data_counter_seen:
+            return
+        self._chart_data_counter_seen = chart_data_counter
+
+        if __debug__ and DEBUG:
             tprint("update_chart")
 
         for tscurve in self.tscurves:
@@ -369,27 +432,21 @@ class MainWindow(QtWid.QWidget):
 
 
 def stop_running():
-    app.processEvents()
+    # `quit()` blocks until the DAQ worker has stopped, so after this no more
+    # log rows can come in
     qdev_ard.quit()
-    log.close()
 
     print("Stopping timers................ ", end="")
     timer_GUI.stop()
     timer_charts.stop()
+    timer_log_flush.stop()
     print("done.")
 
+    flush_log_buffer()
+    log.close()
 
-@QtCore.pyqtSlot()
-def notify_connection_lost():
-    stop_running()
 
-    window.qlbl_title.setText("! ! !    LOST CONNECTION    ! ! !")
-    str_cur_date, str_cur_time, _ = get_current_date_time()
-    str_msg = "%s %s\nLost connection to Arduino." % (
-        str_cur_date,
-        str_cur_time,
-    )
-    print("\nCRITICAL ERROR @ %s" % str_msg)
+def show_connection_lost_warning(str_msg):
     reply = QtWid.QMessageBox.warning(
         window, "CRITICAL ERROR", str_msg, QtWid.QMessageBox.Ok
     )
@@ -398,6 +455,19 @@ def notify_connection_lost():
         pass  # Leave the GUI open for read-only inspection by the user
 
 
+@QtCore.pyqtSlot()
+def notify_connection_lost():
+    stop_running()
+
+    window.qlbl_title.setText("! ! !    LOST CONNECTION    ! ! !")
+    str_msg = "%s\nLost connection to Arduino." % get_current_date_time()
+    print("\nCRITICAL ERROR @ %s" % str_msg)
+
+    # Defer the modal dialog until this slot has returned, so that it does not
+    # spin up a nested event loop in the middle of the teardown
+    QtCore.QTimer.singleShot(0, lambda: show_connection_lost_warning(str_msg))
+
+
 @QtCore.pyqtSlot()
 def about_to_quit():
     print("\nAbout to quit")
@@ -411,58 +481,64 @@ def about_to_quit():
 
 
 def DAQ_function():
-    # Date-time keeping
-    str_cur_date, str_cur_time, str_cur_datetime = get_current_date_time()
-
     # Query the Arduino for its state
     success, tmp_state = ard.query_ascii_values("?", delimiter="\t")
     if not (success):
         dprint(
-            "'%s' reports IOError @ %s %s"
-            % (ard.name, str_cur_date, str_cur_time)
+            "'%s' reports IOError @ %s" % (ard.name, get_current_date_time())
         )
         return False
 
-    # Parse readings into separate state variables
+    # Parse readings. The Arduino time gets discarded, because we will use PC
+    # time instead.
     try:
-        (
-            state.time,
-            state.ds_temp,
-            state.bme_temp,
-            state.bme_humi,
-            state.bme_pres,
-        ) = tmp_state
-        state.time /= 1000  # Arduino time, [msec] to [s]
-        state.bme_pres /= 100  # [Pa] to [mbar]
+        _, ds_temp, bme_temp, bme_humi, bme_pres = tmp_state
     except Exception as err:
         pft(err, 3)
         dprint(
-            "'%s' reports IOError @ %s %s"
-            % (ard.name, str_cur_date, str_cur_time)
+            "'%s' reports IOError @ %s" % (ard.name, get_current_date_time())
         )
         return False
 
     # Catch very intermittent DS18B20 sensor errors
-    if state.ds_temp <= -127.0:
-        state.ds_temp = np.nan
-
-    # We will use PC time instead
-    state.time = time.perf_counter()
-
-    # Add readings to chart histories
+    if ds_temp <= -127.0:
+        ds_temp = np.nan
+
+    # Store into separate state variables. The PC time also serves as the
+    # x-coordinate of the charts. It is deliberately not replaced by a sample
+    # index, as DAQ ticks are not perfectly uniform and failed ticks would
+    # leave no gap. `HistoryChartCurve` shifts the newest x to 0 before
+    # plotting, so the large float offset never reaches the painter.
+    state.time = time.perf_counter()  # [s]
+    state.ds_temp = ds_temp
+    state.bme_temp = bme_temp
+    state.bme_humi = bme_humi
+    state.bme_pres = bme_pres / 100  # [Pa] to [mbar]
+
+    # Add readings to chart histories. Each curve guards its own ring buffers
+    # with a mutex that only gets contended by `update_chart()` taking a brief
+    # snapshot, so appending per curve is cheap and needs no batching.
     window.tscurve_ds_temp.appendData(state.time, state.ds_temp)
     window.tscurve_bme_temp.appendData(state.time, state.bme_temp)
     window.tscurve_bme_humi.appendData(state.time, state.bme_humi)
     window.tscurve_bme_pres.appendData(state.time, state.bme_pres)
+    window.chart_data_counter += 1
 
-    # Logging to file
-    log.update(filepath=str_cur_datetime + ".txt", mode="w")
+    # Logging to file. When a new log gets created, `FileLogger` names it after
+    # the current date-time "yyMMdd_HHmmss.txt" by itself.
+    locker = QtCore.QMutexLocker(log_mutex)
+    log.update(mode="w")
+    locker.unlock()
 
     # Return success
     return True
 
 
 def write_header_to_log():
+    # Safety net: `record_to_log()` already flushes the rows of a previous
+    # recording when it gets stopped, so the buffer should be empty by now
+    log_buffer.clear()
+
     log.write("[HEADER]\n")
     log.write(window.qtxt_comments.toPlainText())
     log.write("\n\n[DATA]\n")
@@ -471,9 +547,8 @@ def write_header_to_log():
 
 
 def write_data_to_log():
-    log.write(
-        "%.1f\t%.1f\t%.1f\t%.1f\t%.1f\n"
-        % (
+    log_buffer.append(
+        (
             log.elapsed(),
             state.ds_temp,
             state.bme_temp,
@@ -483,6 +558,39 @@ def write_data_to_log():
     )
 
 
+def flush_log_buffer():
+    """Write all buffered data rows to the log file with a single call. The
+    caller must either hold `log_mutex` or have stopped the DAQ worker.
+    """
+    if not (log.is_recording() and log_buffer):
+        return
+
+    rows = [log_buffer.popleft() for _ in range(len(log_buffer))]
+    log.write("".join(["%.1f\t%.1f\t%.1f\t%.1f\t%.1f\n" % row for row in rows]))
+
+
+@QtCore.pyqtSlot()
+def periodic_log_flush():
+    locker = QtCore.QMutexLocker(log_mutex)
+    flush_log_buffer()
+    locker.unlock()
+
+
+@QtCore.pyqtSlot(bool)
+def record_to_log(state):
+    if state:
+        log.record(True)
+        return
+
+    # Request the stop and write out the remaining rows in one go. Holding
+    # `log_mutex` makes sure the DAQ thread adds no more rows in between, even
+    # when the user restarts recording before the next DAQ tick.
+    locker = QtCore.QMutexLocker(log_mutex)
+    log.record(False)
+    flush_log_buffer()
+    locker.unlock()
+
+
 # ------------------------------------------------------------------------------
 #   Main
 # ------------------------------------------------------------------------------
@@ -517,7 +625,17 @@ if __name__ == "__main__":
     # --------------------------------------------------------------------------
     QtCore.QThread.currentThread().setObjectName("MAIN")  # For DEBUG info
 
-    app = QtWid.QApplication(sys.argv)
+    # Reuse the application when re-run inside an interactive session, e.g.
+    # via `%run` in IPython or Spyder
+    app = QtWid.QApplication.instance()
+    if app is None:
+        app = QtWid.QApplication(sys.argv)
+    # Drop the handler of a previous run. It would otherwise keep that run's
+    # objects alive and tear them down once more on every later quit.
+    try:
+        app.aboutToQuit.disconnect()
+    except TypeError:
+        pass  # Nothing was connected yet
     app.aboutToQuit.connect(about_to_quit)
 
     window = MainWindow()
@@ -538,6 +656,10 @@ if __name__ == "__main__":
     log.signal_recording_stopped.connect(
         lambda: window.qpbt_record.setText("Click to start recording to file")
     )
+    # Must run inside the DAQ thread, before the log file gets closed
+    log.signal_recording_stopped.connect(
+        flush_log_buffer, QtCore.Qt.DirectConnection
+    )
 
     # --------------------------------------------------------------------------
     #   Set up multithreaded communication with the Arduino
@@ -557,7 +679,7 @@ if __name__ == "__main__":
     # fmt: on
 
     # Connect signals to slots
-    qdev_ard.signal_DAQ_updated.connect(window.update_GUI)
+    qdev_ard.signal_DAQ_updated.connect(window.update_readings)
     qdev_ard.signal_connection_lost.connect(notify_connection_lost)
 
     # Start workers
@@ -575,6 +697,10 @@ if __name__ == "__main__":
     timer_charts.timeout.connect(window.update_chart)
     timer_charts.start(CHART_INTERVAL_MS)
 
+    timer_log_flush = QtCore.QTimer()
+    timer_log_flush.timeout.connect(periodic_log_flush)
+    timer_log_flush.start(LOG_FLUSH_INTERVAL_MS)
+
     # --------------------------------------------------------------------------
     #   Start the main GUI event loop
     # --------------------------------------------------------------------------